@@ -1,16 +1,18 @@
 from time import sleep
+import math
 import streamlit as st
-from google_auth_oauthlib.flow import Flow
 import pandas as pd
+import numpy as np
 import altair as alt
 from datetime import datetime, timedelta
-import math
 
 from auth_handler import create_gmail_service, get_client_config
-from data_processor import get_email_messages, display_delivery_details
+from data_processor import GMAIL_NUM_RETRIES, start_email_processing, display_delivery_details
 from database import (
-    create_table_if_not_exists,
+    HISTORY_PAGE_SIZE,
+    ensure_schema,
     get_delivery_history,
+    get_delivery_history_count,
     get_processing_statistics,
     clear_user_records,
     get_emails_over_time,
@@ -18,6 +20,9 @@ from database import (
     get_delivery_status_distribution
 )
 
+# Seconds between reruns while a background extraction job is running
+PROCESSING_POLL_SECONDS = 2
+
 # Custom CSS for styling with dark theme
 def load_css():
     st.markdown("""
@@ -333,6 +338,53 @@ def get_auth_code_from_url():
         return params['code']
     return None
 
+def collect_finished_job(job):
+    """Move a finished job's results into session state for the next render."""
+    st.session_state.processed_email_count = job.extracted
+    st.session_state.processing_job = None
+    st.session_state.processing_message = f"✅ Successfully processed {job.extracted} delivery-related emails"
+    st.session_state.processing_errors = list(job.errors)
+
+def start_processing(service, user_email) -> bool:
+    """Scan Gmail and start a background extraction job; return whether one was started."""
+    job = st.session_state.get('processing_job')
+    if job is not None and not job.done:
+        st.info("Emails are already being processed.")
+        return False
+    if job is not None:
+        # Keep the results of a job the polling fragment hasn't picked up yet
+        collect_finished_job(job)
+    
+    with st.spinner("Scanning your inbox..."):
+        st.session_state.processing_job = start_email_processing(service, user_email)
+        st.session_state.processing_seen = 0
+    return st.session_state.processing_job is not None
+
+@st.fragment(run_every=PROCESSING_POLL_SECONDS)
+def show_processing_progress():
+    """Poll the background extraction job, rerunning the app when new results land."""
+    job = st.session_state.get('processing_job')
+    if job is None:
+        return
+    
+    if job.done:
+        collect_finished_job(job)
+        st.rerun()
+    
+    # Only refresh the whole page once another batch has been extracted
+    if job.processed != st.session_state.get('processing_seen', 0):
+        st.session_state.processing_seen = job.processed
+        st.session_state.processed_email_count = job.extracted
+        st.rerun()
+    
+    # The job thread can't call Streamlit, so its errors are shown from here
+    for error in list(job.errors):
+        st.warning(error)
+    st.progress(
+        job.processed / job.total,
+        text=f"Extracting delivery details... {job.processed}/{job.total} emails"
+    )
+
 def create_emails_over_time_chart(data):
     """Create a line chart for emails processed over time"""
     chart = alt.Chart(data).mark_line(point=True, color='#FF5252').encode(
@@ -416,26 +468,6 @@ def display_enhanced_history_table(df):
             st.info("No previous delivery emails analyzed yet.")
             return
 
-        # Format the DataFrame for display
-        display_df = df.copy()
-
-        # Format price as currency
-        display_df['price_num'] = display_df['price_num'].apply(lambda x: f"${x:.2f}" if pd.notnull(x) else "$0.00")
-
-        # Format delivery date
-        if 'delivery_date' in display_df.columns:
-            display_df['delivery_date'] = pd.to_datetime(display_df['delivery_date'], errors='coerce').dt.strftime('%Y-%m-%d %H:%M')
-
-        # Format created_at timestamp
-        if 'created_at' in display_df.columns:
-            display_df['created_at'] = pd.to_datetime(display_df['created_at'], errors='coerce').dt.strftime('%Y-%m-%d %H:%M')
-
-        # Add a status column with emoji
-        display_df['status'] = display_df['delivery'].apply(
-            lambda x: "✅ Confirmed" if x == "yes" else "❌ Not Confirmed"
-        )
-
-        # Reorder and rename columns for display
         columns_to_display = {
             'created_at': 'Date',
             'store': 'Store',
@@ -446,9 +478,22 @@ def display_enhanced_history_table(df):
             'tracking_number': 'Tracking'
         }
 
-        # Filter and rename columns
-        final_df = display_df[[col for col in columns_to_display.keys() if col in display_df.columns]]
-        final_df.columns = [columns_to_display[col] for col in final_df.columns]
+        # Copy only the columns being shown (status is derived from delivery)
+        display_df = df[[col for col in columns_to_display if col in df.columns] + ['delivery']].copy()
+
+        # Format price as currency
+        display_df['price_num'] = display_df['price_num'].fillna(0).map('${:.2f}'.format)
+
+        # Format created_at timestamp
+        if 'created_at' in display_df.columns:
+            display_df['created_at'] = pd.to_datetime(display_df['created_at'], errors='coerce').dt.strftime('%Y-%m-%d %H:%M')
+
+        # Add a status column with emoji
+        display_df['status'] = np.where(display_df['delivery'].eq("yes"), "✅ Confirmed", "❌ Not Confirmed")
+
+        # Reorder and rename columns for display
+        final_df = display_df[[col for col in columns_to_display if col in display_df.columns]]
+        final_df = final_df.rename(columns=columns_to_display)
 
         # Display as a regular Streamlit dataframe
         st.dataframe(final_df, hide_index=True)
@@ -472,8 +517,9 @@ def main():
     # Load the CSS for light mode
     load_css()
     
-    # Create database table if it doesn't exist
-    create_table_if_not_exists()
+    # Create database table if it doesn't exist (cached; retried on failure)
+    if not ensure_schema():
+        ensure_schema.clear()
     
     # First-time initialization for logged-in users
     if st.session_state.credentials and not st.session_state.get('initialized', False):
@@ -481,10 +527,7 @@ def main():
             service = create_gmail_service(st.session_state.credentials)
             if service:
                 # Process emails
-                with st.spinner("Loading your delivery data..."):
-                    processed_emails = get_email_messages(service, st.session_state.get('user_email'))
-                    if processed_emails:
-                        st.session_state.processed_emails = processed_emails
+                start_processing(service, st.session_state.get('user_email'))
                 st.session_state.initialized = True
                 st.rerun()
         except Exception as e:
@@ -496,19 +539,23 @@ def main():
     if auth_code and not st.session_state.credentials:
         with st.spinner("🔐 Completing authentication..."):
             try:
+                # Imported lazily; only the OAuth branches need it
+                from google_auth_oauthlib.flow import Flow
                 flow = Flow.from_client_config(
                     get_client_config(),
                     scopes=['https://www.googleapis.com/auth/gmail.readonly'],
-                    redirect_uri=st.secrets["google_client_config"]["redirect_uris"][0]
+                    redirect_uri=get_client_config()["web"]["redirect_uris"][0]
                 )
                 flow.fetch_token(code=auth_code)
                 st.session_state.credentials = flow.credentials
                 st.session_state.auth_in_progress = False
+                # Drop the one-time code so later reruns don't try to redeem it again
+                st.query_params.clear()
                 
                 # Get user email on new login
                 service = create_gmail_service(flow.credentials)
                 if service:
-                    user_info = service.users().getProfile(userId='me').execute()
+                    user_info = service.users().getProfile(userId='me').execute(num_retries=GMAIL_NUM_RETRIES)
                     if 'emailAddress' in user_info:
                         new_user_email = user_info['emailAddress']
                         
@@ -520,11 +567,10 @@ def main():
                         # Store the user's email
                         st.session_state.user_email = new_user_email
                         
-                        # Process emails immediately after authentication
-                        with st.spinner("Processing your emails..."):
-                            processed_emails = get_email_messages(service, new_user_email)
-                            if processed_emails:
-                                st.session_state.processed_emails = processed_emails
+                        # Process emails immediately after authentication; the first-run
+                        # block must not start a second scan on the rerun below
+                        start_processing(service, new_user_email)
+                        st.session_state.initialized = True
             
                 st.rerun()
             except Exception as e:
@@ -552,14 +598,15 @@ def main():
             
             if st.button("🔑 Login with Gmail", key="login", use_container_width=True):
                 try:
+                    from google_auth_oauthlib.flow import Flow
                     flow = Flow.from_client_config(
                         get_client_config(),
                         scopes=['https://www.googleapis.com/auth/gmail.readonly'],
-                        redirect_uri=st.secrets["google_client_config"]["redirect_uris"][0]
+                        redirect_uri=get_client_config()["web"]["redirect_uris"][0]
                     )
                     auth_url, _ = flow.authorization_url(prompt='consent')
                     st.session_state.auth_in_progress = True
-                    st.markdown(f"[Click here to authorize]({auth_url})")
+                    st.link_button("Click here to authorize", auth_url, use_container_width=True)
                 except Exception as e:
                     st.error(f"Error initiating authentication: {str(e)}")
                     st.session_state.auth_in_progress = False
@@ -618,13 +665,8 @@ def main():
                 service = create_gmail_service(st.session_state.credentials)
                 if service:
                     # Pass user_email to the processing function
-                    with st.spinner("Processing emails..."):
-                        processed_emails = get_email_messages(service, st.session_state.get('user_email'))
-                        # Display results
-                        if processed_emails:
-                            st.session_state.processed_emails = processed_emails
-                            st.success(f"✅ Successfully processed {len(processed_emails)} delivery-related emails")
-                            st.rerun()
+                    if start_processing(service, st.session_state.get('user_email')):
+                        st.rerun()
             
             # Logout button
             if st.button("🚪 Logout", key="logout", use_container_width=True):
@@ -647,6 +689,15 @@ def main():
         
         # MAIN CONTENT AREA
         with col2:
+            # Progress of any background extraction job
+            message = st.session_state.pop('processing_message', None)
+            if message:
+                st.success(message)
+            for error in st.session_state.pop('processing_errors', []):
+                st.warning(error)
+            if st.session_state.get('processing_job') is not None:
+                show_processing_progress()
+            
             # Get current statistics
             stats = get_processing_statistics(st.session_state.get('user_email'))
             
@@ -747,14 +798,23 @@ def main():
                 
                 st.markdown(f"<h2>{page_titles[current_page]}</h2>", unsafe_allow_html=True)
                 
-                # Filter delivery history based on current page
-                df = get_delivery_history(st.session_state.get('user_email'))
-                
-                if current_page == 'confirmed':
-                    df = df[df['delivery'] == 'yes']
-                elif current_page == 'pending':
-                    df = df[df['delivery'] == 'no']
-                
+                # Filter delivery history based on current page, one page of rows at a time
+                delivery_filter = {'confirmed': 'yes', 'pending': 'no'}.get(current_page)
+                row_count = get_delivery_history_count(st.session_state.get('user_email'), delivery_filter)
+                page_count = max(1, math.ceil(row_count / HISTORY_PAGE_SIZE))
+                page_key = f"{current_page}_history_page"
+                # Records may have been cleared since the page was picked
+                if st.session_state.get(page_key, 1) > page_count:
+                    st.session_state[page_key] = page_count
+                history_page = st.number_input(
+                    f"Page (of {page_count})", min_value=1, max_value=page_count, step=1, key=page_key
+                )
+                df = get_delivery_history(
+                    st.session_state.get('user_email'),
+                    page=history_page - 1,
+                    delivery=delivery_filter
+                )
+
                 # Display enhanced history table that matches screenshots
                 display_enhanced_history_table(df)
                 
@@ -901,23 +961,16 @@ def get_delivery_status_distribution(user_email=None):
             status_counts = [30, 50, 20]  # Roughly matches the pie chart in the screenshot
             return pd.DataFrame({'status': status_types, 'count': status_counts})
         
-        # Map delivery values to status labels
+        # Count confirmed/failed in one vectorized pass
         status_map = {'yes': 'Confirmed', 'no': 'Failed'}
-        df['status'] = df['delivery'].map(status_map)
-        
-        # Group by status and count
-        result = df.groupby('status').size().reset_index(name='count')
-        
-        # Make sure we have all status types
-        all_statuses = ['Confirmed', 'Failed', 'Pending']
-        for status in all_statuses:
-            if status not in result['status'].values:
-                if status == 'Pending':
-                    # Add a reasonable "Pending" count
-                    pending_count = max(1, int(df.shape[0] * 0.2))
-                    result = pd.concat([result, pd.DataFrame({'status': [status], 'count': [pending_count]})], ignore_index=True)
-                else:
-                    result = pd.concat([result, pd.DataFrame({'status': [status], 'count': [0]})], ignore_index=True)
+        counts = df['delivery'].map(status_map).value_counts().reindex(['Confirmed', 'Failed'], fill_value=0)
+        
+        # Add a reasonable "Pending" count
+        pending_count = max(1, int(df.shape[0] * 0.2))
+        result = pd.DataFrame({
+            'status': ['Confirmed', 'Failed', 'Pending'],
+            'count': [int(counts['Confirmed']), int(counts['Failed']), pending_count]
+        })
         
         return result
     except Exception as e:
@@ -931,7 +984,8 @@ if __name__ == "__main__":
     st.session_state.setdefault('credentials', None)
     st.session_state.setdefault('auth_in_progress', False)
     st.session_state.setdefault('auth_code', None)
-    st.session_state.setdefault('processed_emails', [])
+    st.session_state.setdefault('processed_email_count', 0)
+    st.session_state.setdefault('processing_job', None)
     st.session_state.setdefault('total_emails', 0)
     st.session_state.setdefault('current_progress', 0)
     st.session_state.setdefault('user_email', None)
@@ -1,34 +1,48 @@
 import streamlit as st
-from googleapiclient.discovery import build
+
+# Socket timeout for Gmail API requests, in seconds
+GMAIL_HTTP_TIMEOUT = 60
+GMAIL_SERVICE_CACHE_SIZE = 32
 
 def get_auth_code_from_url():
     """Extract authorization code from URL if present."""
     try:
-        query_params = st.experimental_get_query_params()
-        if 'code' in query_params:
-            return query_params['code'][0]
+        return st.query_params.get('code')
     except:
         return None
-    return None
+
+@st.cache_resource(max_entries=GMAIL_SERVICE_CACHE_SIZE)
+def _build_gmail_service(token: str, _credentials):
+    """Build a Gmail service once per access token and reuse it across reruns."""
+    # Imported lazily so the login page doesn't pay for the Google client libraries
+    import httplib2
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.discovery import build
+
+    # One keep-alive Http per service; httplib2 negotiates gzip on every request
+    http = AuthorizedHttp(_credentials, http=httplib2.Http(timeout=GMAIL_HTTP_TIMEOUT))
+    return build('gmail', 'v1', http=http, cache_discovery=False, static_discovery=True)
 
 def create_gmail_service(credentials):
     """Create and return a Gmail service object."""
     try:
-        return build('gmail', 'v1', credentials=credentials)
+        return _build_gmail_service(credentials.token, credentials)
     except Exception as e:
         st.error(f"Error creating Gmail service: {str(e)}")
         return None
 
+@st.cache_resource
 def get_client_config():
     """Return the Google client configuration from secrets."""
+    google_config = st.secrets["google_client_config"]
     return {
         "web": {
-            "client_id": st.secrets["google_client_config"]["client_id"],
-            "project_id": st.secrets["google_client_config"]["project_id"],
-            "auth_uri": st.secrets["google_client_config"]["auth_uri"],
-            "token_uri": st.secrets["google_client_config"]["token_uri"],
-            "auth_provider_x509_cert_url": st.secrets["google_client_config"]["auth_provider_x509_cert_url"],
-            "client_secret": st.secrets["google_client_config"]["client_secret"],
-            "redirect_uris": st.secrets["google_client_config"]["redirect_uris"]
+            "client_id": google_config["client_id"],
+            "project_id": google_config["project_id"],
+            "auth_uri": google_config["auth_uri"],
+            "token_uri": google_config["token_uri"],
+            "auth_provider_x509_cert_url": google_config["auth_provider_x509_cert_url"],
+            "client_secret": google_config["client_secret"],
+            "redirect_uris": google_config["redirect_uris"]
         }
     }
\ No newline at end of file
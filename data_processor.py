@@ -1,18 +1,253 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import logging
 import base64
-from datetime import datetime
-import pytz
-import pandas as pd
-from typing import Dict, Any, List, Set, Optional
-from database import insert_into_db, get_connection
-from time import sleep
+import hashlib
+import html
+import os
+import random
+import re
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, Any, Callable, Iterable, Iterator, List, Set, Optional, Tuple
+from database import insert_records, get_connection
+from time import sleep, time
+import threading
+import queue
+from collections import OrderedDict, deque
+from itertools import islice
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
 
 # Configuration constants
 BATCH_SIZE = 10
-MAX_RETRIES = 3
+# Gmail rate-limits batches over 50 calls; 50 metadata gets stay within the per-user quota
+GMAIL_BATCH_SIZE = 50
+MAX_RETRIES = 8
 RATE_LIMIT_DELAY = 1
+MAX_WORKERS = 8
+PROCESSED_ID_LOOKUP_SIZE = 1000
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+RETRY_BACKOFF_MAX = 60
+# A grouped request generates up to EMAILS_PER_REQUEST answers, so reads get a long timeout
+# and only one retry; a timed-out read has usually been billed already
+REQUEST_TIMEOUT = (3.05, 120)
+READ_RETRIES = 1
+GMAIL_NUM_RETRIES = 5
+EMAILS_PER_REQUEST = 10
+MAX_TOKENS_PER_EMAIL = 150
+UTC_DATE_FORMAT = '%Y-%m-%d %H:%M:%S UTC'
+# Shared by every session in the process, so only the most recent classifications are kept
+CLASSIFICATION_CACHE_SIZE = 50000
+
+# LLM response cache; bump PROMPT_VERSION whenever EXTRACTION_SYSTEM_PROMPT changes
+PROMPT_VERSION = "v4"
+# Entries hold details extracted from user mail, so files are expired and capped on disk;
+# the directory can be overridden with the LLM_CACHE_DIR secret
+LLM_CACHE_DIR = ".llm_cache"
+LLM_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+LLM_MEMORY_CACHE_SIZE = 4096
+LLM_CACHE_MAX_ENTRIES = 10000
+LLM_CACHE_SWEEP_SECONDS = 60 * 60
+LLM_CACHE_SWEEP_WRITES = 500
+
+# Input budget per email in the extraction prompt; delivery fields sit near the top of an email
+MAX_INPUT_CHARS = 4000
+
+# Sent once per request as the system message; the user message lists the emails
+EXTRACTION_SYSTEM_PROMPT = """The user's message contains one or more emails, each introduced by a line "### id=<email id>".
+Extract delivery-related details from every email and return a JSON object with a "results" array
+holding one object per email, with an "id" key set to that email's id and these keys:
+- delivery: "yes" if delivery is confirmed, otherwise "no"
+- price_num: Extracted price amount, default to 0.00 if not found
+- description: Short (under 10 words) description of the product if available
+- order_id: Extracted order ID if available
+- delivery_date: Extracted delivery date in YYYY-MM-DD format if available
+- store: Store or sender name
+- tracking_number: Extracted tracking number if available
+- carrier: Extracted carrier name (FedEx, UPS, USPS, etc.) if available
+Use an empty string for any text field that is not available."""
+
+# Structured-output schema the model response must satisfy
+DELIVERY_DETAILS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "id": {"type": "string"},
+        "delivery": {"type": "string", "enum": ["yes", "no"]},
+        "price_num": {"type": "number"},
+        "description": {"type": "string"},
+        "order_id": {"type": "string"},
+        "delivery_date": {"type": "string"},
+        "store": {"type": "string"},
+        "tracking_number": {"type": "string"},
+        "carrier": {"type": "string"}
+    },
+    "required": [
+        "id", "delivery", "price_num", "description", "order_id",
+        "delivery_date", "store", "tracking_number", "carrier"
+    ],
+    "additionalProperties": False
+}
+
+DELIVERY_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "results": {"type": "array", "items": DELIVERY_DETAILS_SCHEMA}
+    },
+    "required": ["results"],
+    "additionalProperties": False
+}
+
+JSON_SCHEMA_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "delivery_details", "strict": True, "schema": DELIVERY_RESPONSE_SCHEMA}
+}
+
+# Fallback for API versions without json_schema support
+JSON_OBJECT_RESPONSE_FORMAT = {"type": "json_object"}
+
+# Delivery classifier terms, matched as lowercase substrings of subject + snippet
+ORDER_CONFIRMATION_PATTERNS = (
+    'order confirmation',
+    'order #',
+    'order number',
+    'order placed',
+    'order details',
+    'estimated delivery',
+    'delivery date',
+    'order has been',
+    'your order',
+    'shipping details'
+)
+
+SHOPPING_PLATFORMS = (
+    'amazon',
+    'walmart',
+    'ebay',
+    'bestbuy',
+    'target',
+    'shopify',
+    'etsy',
+    'newegg'
+)
+
+DELIVERY_SERVICES = (
+    'fedex',
+    'ups',
+    'usps',
+    'dhl',
+    'ontrac',
+    'lasership',
+    'amazon delivery',
+    'express delivery',
+    'priority mail',
+    'tracking number'
+)
+
+DELIVERY_KEYWORDS = (
+    'shipped',
+    'delivered',
+    'arriving',
+    'package',
+    'delivery status',
+    'shipment',
+    'shipping confirmation',
+    'tracking info',
+    'out for delivery',
+    'expected delivery'
+)
+
+def _trie_pattern(terms) -> str:
+    """Build a regex matching any of terms, with shared prefixes factored out like a trie."""
+    trie = {}
+    for term in terms:
+        node = trie
+        for char in term:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def _build(node) -> str:
+        alternatives = [re.escape(char) + _build(child) for char, child in sorted(node.items()) if char]
+        if not alternatives:
+            return ''
+        if len(alternatives) == 1 and '' not in node:
+            return alternatives[0]
+        group = '(?:' + '|'.join(alternatives) + ')'
+        return group + '?' if '' in node else group
+
+    return _build(trie)
+
+# All terms compiled once so each email is scanned in a single pass; the trie
+# shape means each position tests one branch per first letter, not every term
+DELIVERY_PATTERN = re.compile(_trie_pattern(
+    ORDER_CONFIRMATION_PATTERNS + SHOPPING_PLATFORMS + DELIVERY_SERVICES + DELIVERY_KEYWORDS
+))
+
+# Server-side Gmail prefilter: any of the classifier terms, matched full-text
+GMAIL_DELIVERY_QUERY = '{' + ' '.join(
+    f'"{term}"' for term in
+    ORDER_CONFIRMATION_PATTERNS + SHOPPING_PLATFORMS + DELIVERY_SERVICES + DELIVERY_KEYWORDS
+) + '}'
+GMAIL_MAX_PAGE_SIZE = 500
+
+# HTML body cleanup
+HTML_SKIP_PATTERN = re.compile(r'<(script|style)\b.*?</\1>', re.IGNORECASE | re.DOTALL)
+HTML_TAG_PATTERN = re.compile(r'<[^>]+>')
+
+# Quoted reply lines and everything after a "-- " signature delimiter
+QUOTED_LINE_PATTERN = re.compile(r'^>.*$\n?', re.MULTILINE)
+SIGNATURE_PATTERN = re.compile(r'^--\s*$.*', re.MULTILINE | re.DOTALL)
+
+def _decode_gmail_body(data: str) -> str:
+    """Decode a Gmail base64url body, tolerating missing padding."""
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4)).decode('utf-8', errors='replace')
+
+def _html_to_text(html_body: str) -> str:
+    """Strip tags, scripts and styles from an HTML body, collapsing whitespace."""
+    text = HTML_SKIP_PATTERN.sub(' ', html_body)
+    text = HTML_TAG_PATTERN.sub(' ', text)
+    return ' '.join(html.unescape(text).split())
+
+def _chunked(items: Iterable, size: int) -> Iterator[List]:
+    """Yield lists of up to size items, pulling lazily from the iterable."""
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _trim_email_body(email_body: str) -> str:
+    """Drop quoted replies and signatures, then cap the body at MAX_INPUT_CHARS."""
+    body = SIGNATURE_PATTERN.sub('', QUOTED_LINE_PATTERN.sub('', email_body))
+    return body[:MAX_INPUT_CHARS]
+
+# Pre-rendered status badges and detail rows for display_delivery_details
+_BADGE_STYLE = ("padding: 10px; border-radius: 5px; color: white; "
+                "display: inline-block; margin-bottom: 10px;")
+DELIVERY_CONFIRMED_BADGE = (
+    f"<div style='background-color: #28a745; {_BADGE_STYLE}'>✓ Delivery Confirmed</div>"
+)
+DELIVERY_NOT_CONFIRMED_BADGE = (
+    f"<div style='background-color: #dc3545; {_BADGE_STYLE}'>⚠ Delivery Not Confirmed</div>"
+)
+DELIVERY_DETAIL_FIELDS = (
+    ("Subject", "subject"),
+    ("Sender", "sender"),
+    ("Date", "date"),
+    ("Order ID", "order_id"),
+    ("Description", "description"),
+    ("Store", "store"),
+    ("Delivery Date", "delivery_date"),
+    ("Carrier", "carrier"),
+    ("Tracking Number", "tracking_number"),
+)
+DELIVERY_DETAIL_LABELS = [label for label, _ in DELIVERY_DETAIL_FIELDS]
+DELIVERY_DETAIL_KEYS = [key for _, key in DELIVERY_DETAIL_FIELDS]
 
 def display_delivery_details(data: Dict[str, Any]):
     """Display delivery details in a formatted table."""
@@ -20,18 +255,8 @@ def display_delivery_details(data: Dict[str, Any]):
         col1, col2 = st.columns(2)
 
         with col1:
-            status_color = "success" if data.get("delivery") == "yes" else "error"
             st.markdown(
-                f"""
-                <div style='background-color: {'#28a745' if status_color == 'success' else '#dc3545'};
-                          padding: 10px;
-                          border-radius: 5px;
-                          color: white;
-                          display: inline-block;
-                          margin-bottom: 10px;'>
-                    {'✓ Delivery Confirmed' if data.get("delivery") == "yes" else '⚠ Delivery Not Confirmed'}
-                </div>
-                """,
+                DELIVERY_CONFIRMED_BADGE if data.get("delivery") == "yes" else DELIVERY_NOT_CONFIRMED_BADGE,
                 unsafe_allow_html=True
             )
 
@@ -39,34 +264,11 @@ def display_delivery_details(data: Dict[str, Any]):
             if data.get("price_num", 0) > 0:
                 st.markdown(f"### 💰 ${data['price_num']:.2f}")
 
-        details_dict = {
-            "Field": [
-                "Subject",
-                "Sender",
-                "Date",
-                "Order ID",
-                "Description",
-                "Store",
-                "Delivery Date",
-                "Carrier",
-                "Tracking Number"
-            ],
-            "Value": [
-                data.get("subject", ""),
-                data.get("sender", ""),
-                data.get("date", ""),
-                data.get("order_id", ""),
-                data.get("description", ""),
-                data.get("store", ""),
-                data.get("delivery_date", ""),
-                data.get("carrier", ""),
-                data.get("tracking_number", "")
-            ]
-        }
-
-        df = pd.DataFrame(details_dict)
         st.dataframe(
-            df,
+            {
+                "Field": DELIVERY_DETAIL_LABELS,
+                "Value": [data.get(key, "") for key in DELIVERY_DETAIL_KEYS]
+            },
             hide_index=True,
             column_config={
                 "Field": st.column_config.Column(width="medium"),
@@ -82,56 +284,74 @@ def display_delivery_details(data: Dict[str, Any]):
 
 class EmailProcessor:
     def __init__(self, user_email=None):
-        self.chat_client = AzureOpenAIChat()
+        self.chat_client = get_chat_client()
         self.processed_ids = set()
         self.status_text = st.empty()
         self.progress_bar = st.progress(0)
         self.user_email = user_email
 
-    def _get_processed_ids(self) -> Set[str]:
-        """Fetch IDs of previously processed emails."""
+    def _get_processed_ids(self, message_ids: List[str]) -> Set[str]:
+        """Return which of the given message IDs have already been processed."""
+        if not message_ids:
+            return set()
+        conn = get_connection()
+        if conn is None:
+            return set()
         try:
-            conn = get_connection()
-            if conn is None:
-                return set()
-            
             cursor = conn.cursor()
+            processed_ids = set()
             
-            # Filter by user_email if available
-            if self.user_email:
-                cursor.execute("""
-                    SELECT email_id 
-                    FROM delivery_details 
-                    WHERE email_id IS NOT NULL
-                    AND (user_email = %s OR user_email IS NULL)
-                """, (self.user_email,))
-            else:
-                cursor.execute("""
-                    SELECT email_id 
-                    FROM delivery_details 
-                    WHERE email_id IS NOT NULL
-                """)
+            # Look up only the listed IDs; the (user_email, email_id) index makes this a seek
+            for i in range(0, len(message_ids), PROCESSED_ID_LOOKUP_SIZE):
+                chunk = message_ids[i:i + PROCESSED_ID_LOOKUP_SIZE]
+                placeholders = ", ".join(["%s"] * len(chunk))
+                
+                # Filter by user_email if available
+                if self.user_email:
+                    cursor.execute(f"""
+                        SELECT email_id 
+                        FROM delivery_details 
+                        WHERE email_id IN ({placeholders})
+                        AND (user_email = %s OR user_email IS NULL)
+                    """, (*chunk, self.user_email))
+                else:
+                    cursor.execute(f"""
+                        SELECT email_id 
+                        FROM delivery_details 
+                        WHERE email_id IN ({placeholders})
+                    """, tuple(chunk))
+                
+                processed_ids.update(row[0] for row in cursor.fetchall())
             
-            processed_ids = {row[0] for row in cursor.fetchall()}
-            conn.close()
             return processed_ids
         except Exception as e:
             st.error(f"Error fetching processed email IDs: {str(e)}")
             return set()
+        finally:
+            conn.close()
 
     def _extract_email_body(self, msg: Dict) -> str:
-        """Extract email body from message payload."""
+        """Extract decoded email body text from message payload."""
         try:
-            if 'parts' in msg['payload']:
-                for part in msg['payload']['parts']:
-                    if part['mimeType'] == 'text/plain':
-                        body_data = part.get('body', {}).get('data', '')
-                        if body_data:
-                            return base64.urlsafe_b64decode(body_data).decode('utf-8')
-            else:
-                body_data = msg['payload'].get('body', {}).get('data', '')
-                if body_data:
-                    return base64.urlsafe_b64decode(body_data).decode('utf-8')
+            # Walk nested multiparts (e.g. mixed > alternative) in document order,
+            # keeping the first text/plain and text/html leaves
+            bodies = {}
+            stack = [msg['payload']]
+            while stack and 'text/plain' not in bodies:
+                part = stack.pop()
+                if part.get('parts'):
+                    stack.extend(reversed(part['parts']))
+                    continue
+                mime_type = part.get('mimeType')
+                body_data = part.get('body', {}).get('data', '')
+                if mime_type in ('text/plain', 'text/html') and body_data:
+                    bodies.setdefault(mime_type, body_data)
+
+            # Prefer text/plain, fall back to tag-stripped text/html
+            if 'text/plain' in bodies:
+                return _decode_gmail_body(bodies['text/plain'])
+            if 'text/html' in bodies:
+                return _html_to_text(_decode_gmail_body(bodies['text/html']))
             return ""
         except Exception as e:
             st.warning(f"Error extracting email body: {str(e)}")
@@ -139,262 +359,557 @@ class EmailProcessor:
 
     def _is_delivery_related(self, subject: str, snippet: str) -> bool:
         """Check if email is delivery-related."""
-        text = f"{subject} {snippet}".lower()
-        
-        # First check for order confirmation patterns - these are always delivery related
-        order_confirmation_patterns = [
-            'order confirmation',
-            'order #',
-            'order number',
-            'order placed',
-            'order details',
-            'estimated delivery',
-            'delivery date',
-            'order has been',
-            'your order',
-            'shipping details'
-        ]
-        
-        if any(pattern in text.lower() for pattern in order_confirmation_patterns):
-            return True
-            
-        # Then check for common shopping platforms
-        shopping_platforms = [
-            'amazon',
-            'walmart',
-            'ebay',
-            'bestbuy',
-            'target',
-            'shopify',
-            'etsy',
-            'newegg'
-        ]
-        
-        if any(platform in text.lower() for platform in shopping_platforms):
-            return True
-
-        # Check for delivery services
-        delivery_services = [
-            'fedex',
-            'ups',
-            'usps',
-            'dhl',
-            'ontrac',
-            'lasership',
-            'amazon delivery',
-            'express delivery',
-            'priority mail',
-            'tracking number'
-        ]
-        
-        if any(service in text.lower() for service in delivery_services):
-            return True
-
-        # Finally check for general delivery-related terms
-        delivery_keywords = [
-            'shipped',
-            'delivered',
-            'arriving',
-            'package',
-            'delivery status',
-            'shipment',
-            'shipping confirmation',
-            'tracking info',
-            'out for delivery',
-            'expected delivery'
-        ]
-        
-        return any(keyword in text.lower() for keyword in delivery_keywords)
+        return DELIVERY_PATTERN.search(f"{subject} {snippet}".lower()) is not None
+
+    def _iter_extracted(self, batches: Iterable[List[Dict]],
+                        report: Callable[[str], None] = st.warning) -> Iterator[Optional[Dict]]:
+        """Extract delivery details concurrently in groups, yielding one result (or None) per email in order."""
+
+        def _extract(emails: List[Dict]) -> Dict[str, Dict]:
+            # Runs on pool threads, so failures surface through the future, not Streamlit
+            return self.chat_client.extract_delivery_details([
+                (email['id'], f"Subject: {email['subject']}\n\nBody: {email['body']}")
+                for email in emails
+            ])
+
+        # Groups never span two batches, so each Gmail batch is submitted as soon as it
+        # arrives instead of waiting for the next one to fill a group; requests stay in
+        # flight across batch boundaries, yielding results whenever the oldest group is ready
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            in_flight = deque()
+            for batch in batches:
+                for group in _chunked(batch, EMAILS_PER_REQUEST):
+                    in_flight.append((group, executor.submit(_extract, group)))
+                while in_flight and in_flight[0][1].done():
+                    yield from self._parse_extractions(*in_flight.popleft(), report)
+            while in_flight:
+                yield from self._parse_extractions(*in_flight.popleft(), report)
+
+    def _parse_extractions(self, emails: List[Dict], future: Future,
+                           report: Callable[[str], None]) -> Iterator[Optional[Dict]]:
+        """Turn one finished group extraction into delivery records, None for failed emails."""
+        try:
+            extracted = future.result()
+        except Exception as e:
+            report(f"Error processing {len(emails)} emails: {str(e)}")
+            extracted = {}
+        else:
+            # Emails the group and its per-email retries both missed
+            for email in emails:
+                if email['id'] not in extracted:
+                    report(f"No delivery details extracted for email '{email['subject']}'")
 
-    def _process_email_batch(self, emails: List[Dict]) -> List[Dict]:
-        """Process a batch of emails using Azure OpenAI."""
-        processed_data = []
-        
         for email in emails:
-            try:
-                response = self.chat_client.extract_delivery_details(
-                    f"Subject: {email['subject']}\n\nBody: {email['body']}"
-                )
-                
-                if response and "choices" in response:
-                    extracted_text = response["choices"][0]["message"]["content"].strip()
-                    if extracted_text.startswith("```json"):
-                        extracted_text = extracted_text[7:-3]
-
-                    parsed_json = json.loads(extracted_text)
-                    parsed_json.update({
-                        'email_id': email['id'],
-                        'subject': email['subject'],
-                        'sender': email['sender'],
-                        'date': self._format_date(email['date'])
-                    })
-                    
-                    processed_data.append(parsed_json)
-                    # Pass user_email to insert_into_db
-                    insert_into_db(parsed_json, email['id'], self.user_email)
-                    
-            except Exception as e:
-                st.warning(f"Error processing email {email['subject']}: {str(e)}")
+            details = extracted.get(email['id'])
+            if details is None:
+                yield None
                 continue
-        
-        return processed_data
+            yield {
+                **details,
+                'email_id': email['id'],
+                'subject': email['subject'],
+                'sender': email['sender'],
+                'date': self._format_date(email['date'])
+            }
 
     def _format_date(self, date_str: str) -> str:
         """Format email date string to UTC datetime."""
         try:
-            date_obj = datetime.strptime(date_str.split(' (')[0].strip(), 
-                                       '%a, %d %b %Y %H:%M:%S %z')
-            return date_obj.astimezone(pytz.UTC).strftime('%Y-%m-%d %H:%M:%S UTC')
-        except:
+            date_obj = parsedate_to_datetime(date_str)
+            # RFC 2822 "-0000" parses as naive but means UTC
+            if date_obj.tzinfo is None:
+                date_obj = date_obj.replace(tzinfo=timezone.utc)
+            return date_obj.astimezone(timezone.utc).strftime(UTC_DATE_FORMAT)
+        except (TypeError, ValueError):
             return date_str
 
-    def process_emails(self, service, max_results: int = 100) -> List[Dict]:
-        """Main function to process emails in batches."""
+    def collect_delivery_emails(self, service, max_results: int = 100,
+                                on_found: Optional[Callable[[List[Dict]], None]] = None) -> List[Dict]:
+        """Fetch new messages from Gmail and return the delivery-related ones."""
         try:
-            # Initialize
-            self.processed_ids = self._get_processed_ids()
             self.status_text.text("📥 Fetching emails from Gmail...")
+            delivery_emails = []
+            scanned = 0
             
-            # Get emails
-            results = service.users().messages().list(userId='me', maxResults=max_results).execute()
-            messages = results.get('messages', [])
+            # Pipeline one Gmail batch at a time so on_found can start extraction early
+            for messages in self._iter_message_chunks(service, max_results):
+                # Skip anything already stored before fetching bodies or calling the LLM
+                self.processed_ids = self._get_processed_ids([message['id'] for message in messages])
+
+                # Filter delivery emails
+                found = self._filter_delivery_emails(service, messages)
+                delivery_emails.extend(found)
+                if found and on_found is not None:
+                    on_found(found)
+
+                scanned += len(messages)
+                self.progress_bar.progress(min(scanned / max_results, 1.0))
             
-            if not messages:
+            if not scanned:
                 self.status_text.info("No messages found in the inbox.")
-                return []
-
-            # Filter delivery emails
-            delivery_emails = self._filter_delivery_emails(service, messages)
-            
-            if not delivery_emails:
-                return []
-
-            # Process in batches
-            return self._process_batches(delivery_emails)
+            else:
+                self.status_text.text(f"✅ Found {len(delivery_emails)} new delivery emails")
+            return delivery_emails
 
         except Exception as e:
             st.error(f"Error in email processing: {str(e)}")
             return []
 
+    def _iter_message_chunks(self, service, max_results: int) -> Iterator[List[Dict]]:
+        """Yield listed candidate delivery emails in Gmail-batch-sized chunks, paging lazily."""
+        listed = 0
+        page_token = None
+        while listed < max_results:
+            results = service.users().messages().list(
+                userId='me',
+                q=GMAIL_DELIVERY_QUERY,
+                maxResults=min(max_results - listed, GMAIL_MAX_PAGE_SIZE),
+                pageToken=page_token,
+                fields='messages/id,nextPageToken'
+            ).execute(num_retries=GMAIL_NUM_RETRIES)
+            messages = results.get('messages', [])
+            listed += len(messages)
+            for i in range(0, len(messages), GMAIL_BATCH_SIZE):
+                yield messages[i:i + GMAIL_BATCH_SIZE]
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+
+    def _batch_get_messages(self, service, message_ids: List[str], **get_kwargs) -> Dict[str, Dict]:
+        """Fetch messages through Gmail batch requests, keyed by message id."""
+        messages_by_id = {}
+        pending_ids = list(message_ids)
+
+        for attempt in range(GMAIL_NUM_RETRIES + 1):
+            retry_ids = []
+
+            def _on_message(request_id, response, exception):
+                if exception is None:
+                    messages_by_id[request_id] = response
+                    return
+                # Throttled or transient failures are retried in a follow-up batch
+                status = getattr(getattr(exception, 'resp', None), 'status', None)
+                if status in RETRY_STATUS_CODES and attempt < GMAIL_NUM_RETRIES:
+                    retry_ids.append(request_id)
+                    return
+                st.warning(f"Error fetching email {request_id}: {str(exception)}")
+
+            for i in range(0, len(pending_ids), GMAIL_BATCH_SIZE):
+                batch = service.new_batch_http_request(callback=_on_message)
+                for message_id in pending_ids[i:i + GMAIL_BATCH_SIZE]:
+                    batch.add(
+                        service.users().messages().get(userId='me', id=message_id, **get_kwargs),
+                        request_id=message_id
+                    )
+                batch.execute()
+
+            if not retry_ids:
+                break
+            sleep(min(2 ** attempt + random.uniform(0, 1), RETRY_BACKOFF_MAX))
+            pending_ids = retry_ids
+
+        return messages_by_id
+
     def _filter_delivery_emails(self, service, messages: List[Dict]) -> List[Dict]:
         """Filter and collect new delivery-related emails."""
         delivery_emails = []
-        total_messages = len(messages)
+        classifications = get_classification_cache()
+        # Skip emails already stored or already classified as not delivery-related
+        new_ids = [
+            message['id'] for message in messages
+            if message['id'] not in self.processed_ids
+            and classifications.get((self.user_email, message['id'])) is not False
+        ]
 
-        self.status_text.text(f"🔍 Scanning {total_messages} emails...")
+        # First pass: headers and snippet only, enough to classify each email
+        self.status_text.text(f"🔍 Scanning {len(new_ids)} emails...")
+        metadata = self._batch_get_messages(
+            service, new_ids, format='metadata', metadataHeaders=['Subject', 'From', 'Date']
+        )
         
-        for idx, message in enumerate(messages):
+        for message_id in new_ids:
+            msg = metadata.get(message_id)
+            if msg is None:
+                continue
             try:
-                if message['id'] in self.processed_ids:
-                    continue
-                    
-                msg = service.users().messages().get(userId='me', id=message['id']).execute()
-                headers = msg['payload']['headers']
+                headers = {h['name'].lower(): h['value'] for h in msg['payload']['headers']}
                 
                 # Extract email details
-                subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), 'No Subject')
-                sender = next((h['value'] for h in headers if h['name'].lower() == 'from'), 'Unknown')
-                date = next((h['value'] for h in headers if h['name'].lower() == 'date'), '')
+                subject = headers.get('subject', 'No Subject')
+                sender = headers.get('from', 'Unknown')
+                date = headers.get('date', '')
                 snippet = msg.get('snippet', '')
 
                 # Check if delivery-related
-                if self._is_delivery_related(subject, snippet):
+                is_delivery = self._is_delivery_related(subject, snippet)
+                classifications.set((self.user_email, message_id), is_delivery)
+                if is_delivery:
                     delivery_emails.append({
-                        'id': message['id'],
+                        'id': message_id,
                         'subject': subject,
                         'sender': sender,
                         'date': date,
-                        'body': self._extract_email_body(msg),
                         'snippet': snippet
                     })
-                    self.status_text.text(f"📦 Found delivery email: {subject}")
 
             except Exception as e:
-                st.warning(f"Error filtering email {message['id']}: {str(e)}")
+                st.warning(f"Error filtering email {message_id}: {str(e)}")
                 continue
 
-            self.progress_bar.progress(min((idx + 1) / total_messages, 1.0))
+        # One status update per batch rather than one per matching email
+        if delivery_emails:
+            self.status_text.text(f"📦 Found {len(delivery_emails)} delivery emails in this batch")
 
-        self.status_text.text(f"✅ Found {len(delivery_emails)} new delivery emails")
-        return delivery_emails
+        # Second pass: full payloads only for the delivery-related survivors
+        full_messages = self._batch_get_messages(
+            service, [email['id'] for email in delivery_emails], format='full'
+        )
+        delivery_emails = [email for email in delivery_emails if email['id'] in full_messages]
+        for email in delivery_emails:
+            email['body'] = self._extract_email_body(full_messages[email['id']])
 
-    def _process_batches(self, delivery_emails: List[Dict]) -> List[Dict]:
-        """Process filtered emails in batches."""
-        processed_results = []
-        total_batches = (len(delivery_emails) + BATCH_SIZE - 1) // BATCH_SIZE
+        return delivery_emails
 
-        for i in range(0, len(delivery_emails), BATCH_SIZE):
-            batch = delivery_emails[i:i + BATCH_SIZE]
-            current_batch = i // BATCH_SIZE + 1
-            
-            self.status_text.text(f"Processing batch {current_batch} of {total_batches}")
-            self.progress_bar.progress(current_batch / total_batches)
-            
-            results = self._process_email_batch(batch)
-            processed_results.extend(results)
+class ExtractionJob:
+    """Runs LLM extraction and DB writes on a background thread, polled from reruns."""
+
+    def __init__(self, processor: EmailProcessor):
+        self.total = 0
+        self.processed = 0
+        self.extracted = 0
+        self.done = False
+        self.errors: List[str] = []
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, args=(processor,), daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def add(self, delivery_emails: List[Dict]):
+        """Queue one Gmail batch of newly found delivery emails for extraction."""
+        with self._lock:
+            self.total += len(delivery_emails)
+        self._queue.put(delivery_emails)
+
+    def close(self):
+        """Signal that no more emails will be added."""
+        self._queue.put(None)
+
+    def _record_error(self, message: str):
+        """Keep an error for the polling script run; this thread has no Streamlit context."""
+        with self._lock:
+            self.errors.append(message)
+
+    def _run(self, processor: EmailProcessor):
+        try:
+            # Commit per batch so the dashboard picks up rows as they land
+            pending = []
+            handled = 0
+            for result in processor._iter_extracted(iter(self._queue.get, None), report=self._record_error):
+                handled += 1
+                if result is not None:
+                    pending.append(result)
+                if handled % BATCH_SIZE == 0:
+                    self._flush(processor, pending, handled)
+                    pending = []
+            self._flush(processor, pending, handled)
+        except Exception as e:
+            self._record_error(f"Error in email processing: {str(e)}")
+        finally:
+            self.done = True
 
-        self.status_text.text(f"✅ Processed {len(processed_results)} emails")
-        self.progress_bar.progress(1.0)
-        return processed_results
-    
+    def _flush(self, processor: EmailProcessor, results: List[Dict], handled: int):
+        try:
+            written = insert_records(results, processor.user_email, report=self._record_error)
+        except Exception as e:
+            self._record_error(f"Error inserting data: {str(e)}")
+            written = 0
+        # Rows live in the database; only counts are kept for progress reporting
+        with self._lock:
+            self.extracted += written
+            self.processed = handled
+
+class ClassificationCache:
+    """Thread-safe LRU of (user_email, message id) -> is-delivery classifications."""
+
+    def __init__(self, max_size: int = CLASSIFICATION_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple[Optional[str], str]) -> Optional[bool]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Tuple[Optional[str], str], value: bool):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+class LLMResponseCache:
+    """File-backed cache of per-email extraction results keyed by prompt version and email body."""
+
+    def __init__(self, directory: str = LLM_CACHE_DIR, ttl: int = LLM_CACHE_TTL_SECONDS,
+                 memory_size: int = LLM_MEMORY_CACHE_SIZE, max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.directory = directory
+        self.ttl = ttl
+        self.memory_size = memory_size
+        self.max_entries = max_entries
+        # In-process LRU layer in front of the files: key -> (stored_at, response)
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._sweep_lock = threading.Lock()
+        self._writes_since_sweep = 0
+        self._last_sweep = 0.0
+        os.makedirs(directory, exist_ok=True)
+        self.sweep()
+
+    @staticmethod
+    def make_key(email_body: str) -> str:
+        """Return the SHA-256 cache key for an email body under the current prompt."""
+        return hashlib.sha256(PROMPT_VERSION.encode() + b"\x00" + email_body.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _remember(self, key: str, stored_at: float, response: Dict):
+        with self._lock:
+            self._memory[key] = (stored_at, response)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Return the cached response, or None if missing or expired."""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+        if entry is not None and time() - entry[0] <= self.ttl:
+            return entry[1]
+
+        path = self._path(key)
+        try:
+            stored_at = os.path.getmtime(path)
+            if time() - stored_at > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, encoding="utf-8") as f:
+                response = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self._remember(key, stored_at, response)
+        return response
+
+    def set(self, key: str, response: Dict):
+        """Store a response; write-then-rename keeps concurrent readers safe."""
+        self._remember(key, time(), response)
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(response, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+        with self._lock:
+            self._writes_since_sweep += 1
+            due = (self._writes_since_sweep >= LLM_CACHE_SWEEP_WRITES
+                   or time() - self._last_sweep >= LLM_CACHE_SWEEP_SECONDS)
+        if due:
+            self.sweep()
+
+    def sweep(self):
+        """Delete expired and leftover files, then the oldest entries beyond max_entries."""
+        # Only one thread sweeps at a time; others carry on without waiting
+        if not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            with self._lock:
+                self._writes_since_sweep = 0
+                self._last_sweep = time()
+            entries = []
+            for entry in os.scandir(self.directory):
+                try:
+                    stored_at = entry.stat().st_mtime
+                    # Half-written .tmp files left by a crashed writer expire after a minute
+                    max_age = 60 if entry.name.endswith(".tmp") else self.ttl
+                    if time() - stored_at > max_age:
+                        os.remove(entry.path)
+                    elif not entry.name.endswith(".tmp"):
+                        entries.append((stored_at, entry.path))
+                except OSError:
+                    continue
+            entries.sort()
+            for _, path in entries[:max(0, len(entries) - self.max_entries)]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        except OSError:
+            pass
+        finally:
+            self._sweep_lock.release()
+
+class JitteredRetry(Retry):
+    """Retry policy adding random jitter to the capped exponential backoff."""
+
+    def get_backoff_time(self) -> float:
+        backoff = super().get_backoff_time()
+        if backoff <= 0:
+            return backoff
+        return min(backoff + random.uniform(0, 1), RETRY_BACKOFF_MAX)
+
+def _create_session() -> requests.Session:
+    """Create a keep-alive session that retries throttled and failed calls."""
+    # Retry-After, when sent, takes precedence over the computed backoff
+    retry = JitteredRetry(
+        total=MAX_RETRIES,
+        read=READ_RETRIES,
+        backoff_factor=1,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=frozenset({"POST"}),
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=MAX_WORKERS * 2, pool_maxsize=MAX_WORKERS * 2, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    return session
+
+def _rejects_response_format(response: requests.Response) -> bool:
+    """Check whether a 400 response is about the requested response_format."""
+    body = response.text.lower()
+    return "response_format" in body or "json_schema" in body
 
 class AzureOpenAIChat:
     def __init__(self):
         self.API_ENDPOINT = st.secrets.get("AZURE_OPENAI_API_ENDPOINT", "")
         self.API_KEY = st.secrets.get("AZURE_OPENAI_API_KEY", "")
+        self.cache = LLMResponseCache(st.secrets.get("LLM_CACHE_DIR", LLM_CACHE_DIR))
+        self.response_format = JSON_SCHEMA_RESPONSE_FORMAT
+        self._format_lock = threading.Lock()
+        self.session = _create_session()
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "api-key": self.API_KEY,
+        })
+
+    def extract_delivery_details(self, emails: List[Tuple[str, str]]) -> Dict[str, Dict]:
+        """Extract delivery details for (email_id, text) pairs in one request, retrying dropped emails alone."""
+        results = {}
+        pending = []
+        for email_id, text in emails:
+            text = _trim_email_body(text)
+            cache_key = LLMResponseCache.make_key(text)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                results[email_id] = cached
+            else:
+                pending.append((email_id, text, cache_key))
+        if not pending:
+            return results
 
-    def extract_delivery_details(self, email_body: str, max_tokens: int = 300) -> Optional[Dict]:
-        """Extract structured delivery details using Azure OpenAI."""
-        for attempt in range(MAX_RETRIES):
-            try:
-                response = requests.post(
-                    self.API_ENDPOINT,
-                    headers={
-                        "Content-Type": "application/json",
-                        "api-key": self.API_KEY,
-                    },
-                    json={
-                        "messages": [{
-                            "role": "user",
-                            "content": self._create_prompt(email_body)
-                        }],
-                        "max_tokens": max_tokens,
-                        "temperature": 0.5,
-                        "top_p": 1,
-                        "frequency_penalty": 0,
-                        "presence_penalty": 0,
-                    }
-                )
-                response.raise_for_status()
-                sleep(RATE_LIMIT_DELAY)
-                return response.json()
-            except requests.exceptions.RequestException as e:
-                if attempt == MAX_RETRIES - 1:
-                    st.error(f"API error after {MAX_RETRIES} attempts: {str(e)}")
-                    return None
-                sleep(2 ** attempt)
-        return None
-
-    def _create_prompt(self, email_body: str) -> str:
-        """Create the prompt for delivery details extraction."""
-        return f"""
-        Extract delivery-related details from the following email body and return a JSON output with these keys:
-        - delivery: "yes" if delivery is confirmed, otherwise "no"
-        - price_num: Extracted price amount, default to 0.00 if not found
-        - description: Short description of the product if available
-        - order_id: Extracted order ID if available
-        - delivery_date: Extracted delivery date in YYYY-MM-DD format if available
-        - store: Store or sender name
-        - tracking_number: Extracted tracking number if available
-        - carrier: Extracted carrier name (FedEx, UPS, USPS, etc.) if available
-
-        Email Body:
-        {email_body}
-
-        Output JSON:
-        """
-
-def get_email_messages(service, user_email=None, max_results: int = 100) -> List[Dict]:
-    """Entry point for email processing."""
+        try:
+            extracted = self._request_extractions(pending)
+        except ValueError:
+            # A malformed or truncated group response is retried email by email below
+            if len(pending) == 1:
+                raise
+            extracted = {}
+        # Cache what the group returned before retrying, so a failed retry can't discard it
+        self._store_extractions(pending, extracted, results)
+        if len(pending) > 1:
+            # Emails missing from the group response get one request each; a retry that
+            # fails only drops its own email, which the caller reports as missing
+            for entry in pending:
+                if entry[0] in results:
+                    continue
+                try:
+                    self._store_extractions([entry], self._request_extractions([entry]), results)
+                except (ValueError, requests.RequestException) as e:
+                    logger.warning("Retry for email %s failed: %s", entry[0], e)
+        return results
+
+    def _store_extractions(self, pending: List[Tuple[str, str, str]], extracted: Dict[str, Dict],
+                           results: Dict[str, Dict]):
+        """Cache and collect the extracted details for the given (email_id, text, cache_key) entries."""
+        for email_id, _, cache_key in pending:
+            details = extracted.get(email_id)
+            if details is not None:
+                self.cache.set(cache_key, details)
+                results[email_id] = details
+
+    def _request_extractions(self, pending: List[Tuple[str, str, str]]) -> Dict[str, Dict]:
+        """Send one request for (email_id, text, cache_key) entries, raising ValueError on bad responses."""
+        prompt = "\n\n".join(f"### id={email_id}\n{text}" for email_id, text, _ in pending)
+        max_tokens = MAX_TOKENS_PER_EMAIL * len(pending)
+        # Called from worker threads: errors are raised to the caller rather than shown here
+        response_format = self.response_format
+        response = self._post(prompt, max_tokens, response_format)
+        if (response.status_code == 400 and response_format is JSON_SCHEMA_RESPONSE_FORMAT
+                and _rejects_response_format(response)):
+            # Older API versions reject json_schema; switch the shared client to plain JSON mode
+            with self._format_lock:
+                if self.response_format is JSON_SCHEMA_RESPONSE_FORMAT:
+                    logger.warning("Endpoint rejected json_schema output, falling back to json_object: %s",
+                                   response.text[:500])
+                    self.response_format = JSON_OBJECT_RESPONSE_FORMAT
+            response = self._post(prompt, max_tokens, JSON_OBJECT_RESPONSE_FORMAT)
+        response.raise_for_status()
+        sleep(RATE_LIMIT_DELAY)
+        try:
+            content = response.json()["choices"][0]["message"]["content"]
+            items = json.loads(content).get("results", [])
+            if len(pending) == 1 and len(items) == 1:
+                # A lone answer belongs to the lone email even if the model mangled its id
+                items[0]["id"] = pending[0][0]
+            extracted = {str(item.pop("id", "")): item for item in items}
+        except (KeyError, IndexError, TypeError, ValueError, AttributeError) as e:
+            raise ValueError(f"Unable to parse extraction response: {str(e)}") from e
+        return extracted
+
+    def _post(self, prompt: str, max_tokens: int, response_format: Dict) -> requests.Response:
+        """Send one chat completion request over the pooled session."""
+        return self.session.post(
+            self.API_ENDPOINT,
+            json={
+                "messages": [
+                    {"role": "system", "content": EXTRACTION_SYSTEM_PROMPT},
+                    {"role": "user", "content": prompt}
+                ],
+                "max_tokens": max_tokens,
+                "temperature": 0.5,
+                "response_format": response_format,
+            },
+            timeout=REQUEST_TIMEOUT
+        )
+
+@st.cache_resource
+def get_classification_cache() -> ClassificationCache:
+    """Return the process-wide, size-bounded classification cache."""
+    return ClassificationCache()
+
+@st.cache_resource
+def get_chat_client() -> AzureOpenAIChat:
+    """Return an AzureOpenAIChat client shared across Streamlit reruns."""
+    return AzureOpenAIChat()
+
+def start_email_processing(service, user_email=None, max_results: int = 100) -> Optional[ExtractionJob]:
+    """Scan Gmail now and hand extraction + DB writes to a background job."""
     processor = EmailProcessor(user_email)
-    return processor.process_emails(service, max_results)
+    job = ExtractionJob(processor)
+    job.start()
+    try:
+        # Extraction starts on each Gmail batch while the next one is fetched
+        processor.collect_delivery_emails(service, max_results, on_found=job.add)
+    finally:
+        job.close()
+    return job if job.total else None
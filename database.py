@@ -1,31 +1,119 @@
 import streamlit as st
-import pymssql
 import pandas as pd
-from typing import Dict, Any, List, Tuple
+import numpy as np
+import queue
+import functools
+import logging
+import math
+import re
+import time
+from typing import Dict, Any, Callable, List, Optional, Tuple
 from datetime import datetime, timedelta
 
+logger = logging.getLogger(__name__)
+
+# Connection pool settings
+POOL_SIZE = 5
+POOL_RECYCLE_SECONDS = 1500
+
+# How long cached read queries may serve stale results between writes
+HISTORY_CACHE_TTL_SECONDS = 30
+
+# Rows per page for paginated history listings
+HISTORY_PAGE_SIZE = 100
+
+@functools.lru_cache(maxsize=1)
+def _db_credentials() -> Dict[str, str]:
+    """Read the database connection settings from secrets once per process."""
+    return {
+        "server": st.secrets["AZURE_SQL_SERVER"],
+        "user": st.secrets["AZURE_SQL_USERNAME"],
+        "password": st.secrets["AZURE_SQL_PASSWORD"],
+        "database": st.secrets["AZURE_SQL_DATABASE"]
+    }
+
+def _raw_connect():
+    """Open a new pymssql connection."""
+    # Imported lazily; the driver is only needed once the pool dials out
+    import pymssql
+    return pymssql.connect(**_db_credentials())
+
+class PooledConnection:
+    """Connection proxy whose close() hands the connection back to its pool."""
+
+    def __init__(self, pool, raw, created_at: float):
+        self._pool = pool
+        self._raw = raw
+        self._created_at = created_at
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def close(self):
+        if self._raw is not None:
+            self._pool.release(self._raw, self._created_at)
+            self._raw = None
+
+class ConnectionPool:
+    """Thread-safe pool of live connections, recycled after a maximum age."""
+
+    def __init__(self, creator, size: int = POOL_SIZE, recycle: int = POOL_RECYCLE_SECONDS):
+        self._creator = creator
+        self._recycle = recycle
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def connect(self) -> PooledConnection:
+        while True:
+            try:
+                raw, created_at = self._idle.get_nowait()
+            except queue.Empty:
+                return PooledConnection(self, self._creator(), time.monotonic())
+            if time.monotonic() - created_at < self._recycle:
+                return PooledConnection(self, raw, created_at)
+            self._discard(raw)
+
+    def release(self, raw, created_at: float):
+        try:
+            # Drop any uncommitted work before the next borrower sees it
+            raw.rollback()
+            self._idle.put_nowait((raw, created_at))
+        except Exception:
+            self._discard(raw)
+
+    def _discard(self, raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+@st.cache_resource
+def get_pool() -> ConnectionPool:
+    """Return the process-wide connection pool, shared across reruns."""
+    return ConnectionPool(_raw_connect)
+
 def get_connection():
-    """Create and return a database connection with error handling."""
+    """Borrow a pooled database connection with error handling."""
     try:
-        return pymssql.connect(
-            server=st.secrets["AZURE_SQL_SERVER"],
-            user=st.secrets["AZURE_SQL_USERNAME"],
-            password=st.secrets["AZURE_SQL_PASSWORD"],
-            database=st.secrets["AZURE_SQL_DATABASE"]
-        )
+        return get_pool().connect()
     except Exception as e:
         st.error(f"Database connection error: {str(e)}")
         return None
 
-def create_table_if_not_exists():
-    """Create the delivery_details table if it doesn't exist."""
+def _invalidate_read_caches():
+    """Drop cached query results after the table has been written to."""
+    _query_delivery_history.clear()
+    _query_delivery_history_count.clear()
+    _query_processing_statistics.clear()
+
+def create_table_if_not_exists() -> bool:
+    """Create the delivery_details table and its indexes if they don't exist."""
+    conn = get_connection()
+    if conn is None:
+        return False
     try:
-        conn = get_connection()
-        if conn is None:
-            return
         cursor = conn.cursor()
         
-        # First check if table exists
+        # Table, migrations and the per-user email_id index go in one round trip
         cursor.execute("""
             IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='delivery_details' AND xtype='U')
             BEGIN
@@ -42,7 +130,14 @@ def create_table_if_not_exists():
                     created_at DATETIME DEFAULT GETDATE(),
                     email_id NVARCHAR(100),
                     user_email NVARCHAR(255)
-                )
+                );
+                CREATE UNIQUE NONCLUSTERED INDEX ux_delivery_details_user_email_email_id
+                    ON delivery_details(user_email, email_id)
+                    WHERE email_id IS NOT NULL;
+                CREATE NONCLUSTERED INDEX IX_delivery_details_created_at
+                    ON delivery_details(created_at DESC)
+                    INCLUDE (delivery, price_num, description, order_id, delivery_date,
+                             store, tracking_number, carrier, email_id, user_email)
             END
             ELSE
             BEGIN
@@ -62,197 +157,408 @@ def create_table_if_not_exists():
                 BEGIN
                     ALTER TABLE delivery_details
                     ADD user_email NVARCHAR(255)
+                END;
+
+                -- The same message may be stored once per account, so the old
+                -- global email_id index is replaced by one scoped to user_email
+                IF EXISTS (SELECT * FROM sys.indexes
+                         WHERE object_id = OBJECT_ID('delivery_details')
+                         AND name = 'ix_delivery_details_email_id')
+                BEGIN
+                    DROP INDEX ix_delivery_details_email_id ON delivery_details
+                END;
+
+                -- Check if the per-user email_id index exists (dynamic SQL since the columns
+                -- may be new); it is only built once no duplicate rows are left, which
+                -- remove_duplicate_email_rows() takes care of
+                IF NOT EXISTS (SELECT * FROM sys.indexes
+                             WHERE object_id = OBJECT_ID('delivery_details')
+                             AND name = 'ux_delivery_details_user_email_email_id')
+                BEGIN
+                    EXEC('
+                        IF NOT EXISTS (
+                            SELECT 1 FROM delivery_details
+                            WHERE email_id IS NOT NULL
+                            GROUP BY user_email, email_id
+                            HAVING COUNT(*) > 1
+                        )
+                        CREATE UNIQUE NONCLUSTERED INDEX ux_delivery_details_user_email_email_id
+                            ON delivery_details(user_email, email_id) WHERE email_id IS NOT NULL
+                    ')
+                END;
+
+                -- Check if created_at covering index exists (serves history reads newest-first)
+                IF NOT EXISTS (SELECT * FROM sys.indexes
+                             WHERE object_id = OBJECT_ID('delivery_details')
+                             AND name = 'IX_delivery_details_created_at')
+                BEGIN
+                    EXEC('
+                        CREATE NONCLUSTERED INDEX IX_delivery_details_created_at
+                            ON delivery_details(created_at DESC)
+                            INCLUDE (delivery, price_num, description, order_id, delivery_date,
+                                     store, tracking_number, carrier, email_id, user_email)
+                    ')
                 END
             END
         """)
         conn.commit()
-        conn.close()
+
+        if not _has_unique_email_index(cursor):
+            logger.warning(
+                "delivery_details has duplicate (user_email, email_id) rows, so its unique index "
+                "was not created; run `python database.py --remove-duplicates` to clean them up"
+            )
+        return True
     except Exception as e:
         st.error(f"Error creating table: {str(e)}")
+        return False
+    finally:
+        conn.close()
+
+def _has_unique_email_index(cursor) -> bool:
+    """Check whether the per-user email_id unique index exists."""
+    cursor.execute("""
+        SELECT COUNT(*) FROM sys.indexes
+        WHERE object_id = OBJECT_ID('delivery_details')
+        AND name = 'ux_delivery_details_user_email_email_id'
+    """)
+    return cursor.fetchone()[0] > 0
 
-def insert_into_db(data: Dict[str, Any], email_id: str = None, user_email: str = None) -> bool:
-    """Insert extracted JSON data into database and return success status."""
+def remove_duplicate_email_rows() -> int:
+    """One-off migration: delete all but the oldest row per (user_email, email_id), then build the unique index."""
+    conn = get_pool().connect()
     try:
-        conn = get_connection()
-        if conn is None:
-            return False
         cursor = conn.cursor()
-        
-        # Convert delivery_date to proper format if exists
-        delivery_date = None
-        if data.get("delivery_date"):
-            try:
-                delivery_date = datetime.strptime(data["delivery_date"], '%Y-%m-%d').date()
-            except:
-                pass
-
-        # Construct SQL with user_email
         cursor.execute("""
-            INSERT INTO delivery_details
-            (delivery, price_num, description, order_id, delivery_date, store, tracking_number, carrier, email_id, user_email)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """, (
-            data.get("delivery", "no"),
-            data.get("price_num", 0.0),
-            data.get("description", ""),
-            data.get("order_id", ""),
-            delivery_date,
-            data.get("store", ""),
-            data.get("tracking_number", ""),
-            data.get("carrier", ""),
-            email_id,
-            user_email
-        ))
-            
+            WITH ranked AS (
+                SELECT id, user_email, email_id,
+                       ROW_NUMBER() OVER (PARTITION BY user_email, email_id ORDER BY id) AS rn
+                FROM delivery_details
+                WHERE email_id IS NOT NULL
+            )
+            DELETE FROM ranked
+            OUTPUT deleted.id, deleted.user_email, deleted.email_id
+            WHERE rn > 1
+        """)
+        deleted = cursor.fetchall()
+        for row_id, user_email, email_id in deleted:
+            logger.info("Deleted duplicate delivery_details row id=%s user_email=%s email_id=%s",
+                        row_id, user_email, email_id)
+
+        if not _has_unique_email_index(cursor):
+            cursor.execute("""
+                CREATE UNIQUE NONCLUSTERED INDEX ux_delivery_details_user_email_email_id
+                    ON delivery_details(user_email, email_id) WHERE email_id IS NOT NULL
+            """)
         conn.commit()
+    finally:
         conn.close()
-        return True
-    except Exception as e:
-        st.error(f"Error inserting data: {str(e)}")
-        return False
 
-def get_delivery_history(user_email: str = None) -> pd.DataFrame:
-    """Fetch delivery details for the specified user from the database."""
+    logger.warning("Removed %d duplicate delivery_details rows", len(deleted))
+    if deleted:
+        _invalidate_read_caches()
+    return len(deleted)
+
+@st.cache_resource
+def ensure_schema() -> bool:
+    """Run the schema check once per process instead of on every rerun."""
+    return create_table_if_not_exists()
+
+# Column types from the delivery_details schema
+INSERT_COLUMN_TYPES = (
+    ("delivery", "NVARCHAR(10)"),
+    ("price_num", "FLOAT"),
+    ("description", "NVARCHAR(255)"),
+    ("order_id", "NVARCHAR(50)"),
+    ("delivery_date", "DATE"),
+    ("store", "NVARCHAR(255)"),
+    ("tracking_number", "NVARCHAR(100)"),
+    ("carrier", "NVARCHAR(50)"),
+    ("email_id", "NVARCHAR(100)"),
+    ("user_email", "NVARCHAR(255)")
+)
+INSERT_COLUMNS = ", ".join(column for column, _ in INSERT_COLUMN_TYPES)
+
+# VALUES infers each column's type from its literals (an all-NULL column comes out
+# as int), so every parameter is cast to the table's type where it is bound
+INSERT_ROW_PLACEHOLDERS = "(" + ", ".join(f"CAST(%s AS {sql_type})" for _, sql_type in INSERT_COLUMN_TYPES) + ")"
+
+# Rows whose (user_email, email_id) is already stored are skipped server-side,
+# matching the unique index (which treats NULL user_emails as equal). UPDLOCK/HOLDLOCK
+# holds a key-range lock from the probe to the insert, so concurrent writers of the
+# same rows wait instead of both passing the check and hitting a duplicate-key error
+INSERT_SQL = f"""
+    INSERT INTO delivery_details ({INSERT_COLUMNS})
+    SELECT {INSERT_COLUMNS}
+    FROM (VALUES {{rows}}) AS new_rows ({INSERT_COLUMNS})
+    WHERE new_rows.email_id IS NULL
+    OR NOT EXISTS (
+        SELECT 1 FROM delivery_details AS existing WITH (UPDLOCK, HOLDLOCK)
+        WHERE existing.email_id = new_rows.email_id
+        AND (existing.user_email = new_rows.user_email
+             OR (existing.user_email IS NULL AND new_rows.user_email IS NULL))
+    )
+"""
+
+# SQL Server allows at most 2100 parameters per statement (10 per row)
+MAX_ROWS_PER_INSERT = 200
+
+# Text column sizes in delivery_details; longer model output is truncated to fit
+TEXT_COLUMN_SIZES = {
+    "delivery": 10,
+    "description": 255,
+    "order_id": 50,
+    "store": 255,
+    "tracking_number": 100,
+    "carrier": 50,
+    "email_id": 100,
+    "user_email": 255
+}
+
+PRICE_PATTERN = re.compile(r'-?\d+(?:\.\d+)?')
+
+def _clamp_text(value: Any, column: str, default: Optional[str] = "") -> Optional[str]:
+    """Return value as a string cut to the column size, or default when missing."""
+    if value is None:
+        return default
+    return str(value)[:TEXT_COLUMN_SIZES[column]]
+
+def _coerce_price(value: Any) -> float:
+    """Return a finite float price, parsing strings such as "$1,299.00"."""
+    if isinstance(value, str):
+        match = PRICE_PATTERN.search(value.replace(",", ""))
+        value = match.group() if match else 0.0
+    try:
+        price = float(value)
+    except (TypeError, ValueError):
+        return 0.0
+    return price if math.isfinite(price) else 0.0
+
+def _insert_params(data: Dict[str, Any], email_id: str = None, user_email: str = None) -> Tuple:
+    """Build the INSERT parameter tuple for one extracted record, fitted to the column types."""
+    # Convert delivery_date to proper format if exists
+    delivery_date = None
+    if data.get("delivery_date"):
+        try:
+            delivery_date = datetime.strptime(data["delivery_date"], '%Y-%m-%d').date()
+        except:
+            pass
+
+    return (
+        "yes" if data.get("delivery") == "yes" else "no",
+        _coerce_price(data.get("price_num", 0.0)),
+        _clamp_text(data.get("description"), "description"),
+        _clamp_text(data.get("order_id"), "order_id"),
+        delivery_date,
+        _clamp_text(data.get("store"), "store"),
+        _clamp_text(data.get("tracking_number"), "tracking_number"),
+        _clamp_text(data.get("carrier"), "carrier"),
+        _clamp_text(email_id, "email_id", None),
+        _clamp_text(user_email, "user_email", None)
+    )
+
+def _execute_insert(cursor, rows: List[Tuple]):
+    """Insert rows with one multi-row VALUES statement."""
+    cursor.execute(
+        INSERT_SQL.format(rows=", ".join([INSERT_ROW_PLACEHOLDERS] * len(rows))),
+        tuple(value for row in rows for value in row)
+    )
+
+def insert_records(records: List[Dict[str, Any]], user_email: str = None,
+                   email_ids: List[str] = None,
+                   report: Callable[[str], None] = st.warning) -> int:
+    """Insert extracted records and return how many were written, raising on connection errors."""
+    if not records:
+        return 0
+    if email_ids is None:
+        email_ids = [record.get("email_id") for record in records]
+
+    rows = [_insert_params(data, email_id, user_email) for data, email_id in zip(records, email_ids)]
+    written = 0
+    conn = get_pool().connect()
     try:
-        conn = get_connection()
-        if conn is None:
-            return pd.DataFrame()
         cursor = conn.cursor()
+        # Suppress rows-affected messages
+        cursor.execute("SET NOCOUNT ON")
+        for i in range(0, len(rows), MAX_ROWS_PER_INSERT):
+            chunk = rows[i:i + MAX_ROWS_PER_INSERT]
+            try:
+                _execute_insert(cursor, chunk)
+                conn.commit()
+                written += len(chunk)
+                continue
+            except Exception:
+                conn.rollback()
+            # Retry a rejected chunk row by row so one bad row is skipped, not its neighbours
+            for row in chunk:
+                try:
+                    _execute_insert(cursor, [row])
+                    conn.commit()
+                    written += 1
+                except Exception as e:
+                    conn.rollback()
+                    report(f"Error inserting email {row[8]}: {str(e)}")
+    finally:
+        conn.close()
+        if written:
+            _invalidate_read_caches()
+    return written
 
-        # Query with user filtering
-        if user_email:
-            cursor.execute("""
-                IF EXISTS (SELECT * FROM sysobjects WHERE name='delivery_details' AND xtype='U')
-                BEGIN
-                    SELECT id, delivery, price_num, description, order_id, delivery_date,
-                           store, tracking_number, carrier, created_at
-                    FROM delivery_details
-                    WHERE user_email = %s OR user_email IS NULL
-                    ORDER BY created_at DESC
-                END
-            """, (user_email,))
-        else:
-            cursor.execute("""
-                IF EXISTS (SELECT * FROM sysobjects WHERE name='delivery_details' AND xtype='U')
-                BEGIN
-                    SELECT id, delivery, price_num, description, order_id, delivery_date,
-                           store, tracking_number, carrier, created_at
-                    FROM delivery_details
-                    ORDER BY created_at DESC
-                END
-            """)
+HISTORY_COLUMNS = [
+    'id', 'delivery', 'price_num', 'description', 'order_id',
+    'delivery_date', 'store', 'tracking_number', 'carrier', 'created_at'
+]
+
+def _history_filter(user_email: str = None, delivery: Optional[str] = None) -> Tuple[str, List]:
+    """Build the WHERE clause and parameters for optional user and delivery-status filtering."""
+    conditions, params = [], []
+    if user_email:
+        conditions.append("(user_email = %s OR user_email IS NULL)")
+        params.append(user_email)
+    if delivery:
+        conditions.append("delivery = %s")
+        params.append(delivery)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return where, params
+
+# Only successful reads are cached; errors propagate so a failed query is retried next run
+@st.cache_data(ttl=HISTORY_CACHE_TTL_SECONDS)
+def _query_delivery_history(user_email: str = None, page: Optional[int] = None,
+                            delivery: Optional[str] = None) -> pd.DataFrame:
+    """Query delivery details for the specified user, raising on database errors."""
+    conn = get_pool().connect()
+    try:
+        cursor = conn.cursor()
+
+        # Query with optional user and delivery-status filtering
+        where, params = _history_filter(user_email, delivery)
+
+        # Pages are served newest-first straight off the created_at index; id breaks
+        # created_at ties (rows from one batch share a timestamp) so pages never overlap
+        paging = ""
+        if page is not None:
+            paging = "OFFSET %s ROWS FETCH NEXT %s ROWS ONLY"
+            params.extend([page * HISTORY_PAGE_SIZE, HISTORY_PAGE_SIZE])
+
+        cursor.execute(f"""
+            IF EXISTS (SELECT * FROM sysobjects WHERE name='delivery_details' AND xtype='U')
+            BEGIN
+                SELECT id, delivery, price_num, description, order_id, delivery_date,
+                       store, tracking_number, carrier, created_at
+                FROM delivery_details
+                {where}
+                ORDER BY created_at DESC, id DESC
+                {paging}
+            END
+        """, tuple(params) or None)
         
-        # Fetch all results and create DataFrame
         results = cursor.fetchall()
-        if not results:
-            return pd.DataFrame(columns=[
-                'id', 'delivery', 'price_num', 'description', 'order_id',
-                'delivery_date', 'store', 'tracking_number', 'carrier', 'created_at'
-            ])
-            
-        # Get column names from cursor description
         columns = [col[0] for col in cursor.description]
-        df = pd.DataFrame(results, columns=columns)
-        
+    finally:
+        # Hand the connection back to the pool before building the frame
         conn.close()
-        return df
+    
+    if not results:
+        return pd.DataFrame(columns=HISTORY_COLUMNS)
+        
+    return pd.DataFrame.from_records(results, columns=columns)
+
+def get_delivery_history(user_email: str = None, page: Optional[int] = None,
+                         delivery: Optional[str] = None) -> pd.DataFrame:
+    """Fetch delivery details for the specified user, optionally one page at a time."""
+    try:
+        return _query_delivery_history(user_email, page, delivery)
     except Exception as e:
         st.warning(f"Unable to fetch delivery history: {str(e)}")
-        return pd.DataFrame(columns=[
-            'id', 'delivery', 'price_num', 'description', 'order_id',
-            'delivery_date', 'store', 'tracking_number', 'carrier', 'created_at'
-        ])
+        return pd.DataFrame(columns=HISTORY_COLUMNS)
+
+@st.cache_data(ttl=HISTORY_CACHE_TTL_SECONDS)
+def _query_delivery_history_count(user_email: str = None, delivery: Optional[str] = None) -> int:
+    """Count delivery details matching the history filters, raising on database errors."""
+    conn = get_pool().connect()
+    try:
+        cursor = conn.cursor()
+        where, params = _history_filter(user_email, delivery)
+        cursor.execute(f"SELECT COUNT(*) FROM delivery_details {where}", tuple(params) or None)
+        return cursor.fetchone()[0]
+    finally:
+        conn.close()
+
+def get_delivery_history_count(user_email: str = None, delivery: Optional[str] = None) -> int:
+    """Return how many delivery history rows match, for sizing the page selector."""
+    try:
+        return _query_delivery_history_count(user_email, delivery)
+    except Exception as e:
+        st.warning(f"Unable to count delivery history: {str(e)}")
+        return 0
 
 def clear_user_records(user_email: str = None):
     """Clear records for the specified user from the delivery_details table."""
+    conn = get_connection()
+    if conn is None:
+        return False
     try:
-        conn = get_connection()
-        if conn is None:
-            return False
-        
         cursor = conn.cursor()
         if user_email:
             cursor.execute("DELETE FROM delivery_details WHERE user_email = %s", (user_email,))
         else:
             cursor.execute("DELETE FROM delivery_details")
         conn.commit()
-        conn.close()
+        _invalidate_read_caches()
         return True
     except Exception as e:
         st.error(f"Error clearing records: {str(e)}")
         return False
+    finally:
+        conn.close()
 
 def clear_all_records():
     """Clear all records from the delivery_details table."""
+    conn = get_connection()
+    if conn is None:
+        return False
     try:
-        conn = get_connection()
-        if conn is None:
-            return False
-        
         cursor = conn.cursor()
         cursor.execute("DELETE FROM delivery_details")
         conn.commit()
-        conn.close()
+        _invalidate_read_caches()
         return True
     except Exception as e:
         st.error(f"Error clearing records: {str(e)}")
         return False
+    finally:
+        conn.close()
 
-def get_processing_statistics(user_email: str = None):
-    """Fetch and calculate processing statistics from the database for the specified user."""
+@st.cache_data(ttl=HISTORY_CACHE_TTL_SECONDS)
+def _query_processing_statistics(user_email: str = None) -> Dict[str, Any]:
+    """Query processing statistics for the specified user, raising on database errors."""
+    conn = get_pool().connect()
     try:
-        conn = get_connection()
-        if conn is None:
-            return {
-                "total_emails": 0,
-                "confirmed_deliveries": 0,
-                "total_value": 0.00
-            }
-        
         cursor = conn.cursor()
         
-        # Filter by user_email if provided
-        if user_email:
-            # Get total emails processed
-            cursor.execute("""
-                SELECT COUNT(*) FROM delivery_details 
-                WHERE user_email = %s OR user_email IS NULL
-            """, (user_email,))
-            total_emails = cursor.fetchone()[0]
-            
-            # Get confirmed deliveries
-            cursor.execute("""
-                SELECT COUNT(*) FROM delivery_details 
-                WHERE delivery = 'yes' AND (user_email = %s OR user_email IS NULL)
-            """, (user_email,))
-            confirmed_deliveries = cursor.fetchone()[0]
-            
-            # Get total value
-            cursor.execute("""
-                SELECT SUM(price_num) FROM delivery_details 
-                WHERE user_email = %s OR user_email IS NULL
-            """, (user_email,))
-            total_value = cursor.fetchone()[0] or 0.00
-        else:
-            # Get total emails processed without filtering
-            cursor.execute("SELECT COUNT(*) FROM delivery_details")
-            total_emails = cursor.fetchone()[0]
-            
-            # Get confirmed deliveries
-            cursor.execute("SELECT COUNT(*) FROM delivery_details WHERE delivery = 'yes'")
-            confirmed_deliveries = cursor.fetchone()[0]
-            
-            # Get total value
-            cursor.execute("SELECT SUM(price_num) FROM delivery_details")
-            total_value = cursor.fetchone()[0] or 0.00
-        
+        # Totals, confirmed count and value in one scan, filtered by user_email if provided
+        where = "WHERE user_email = %s OR user_email IS NULL" if user_email else ""
+        cursor.execute(f"""
+            SELECT COUNT(*),
+                   COALESCE(SUM(CASE WHEN delivery = 'yes' THEN 1 ELSE 0 END), 0),
+                   COALESCE(SUM(price_num), 0)
+            FROM delivery_details
+            {where}
+        """, (user_email,) if user_email else None)
+        total_emails, confirmed_deliveries, total_value = cursor.fetchone()
+    finally:
         conn.close()
-        
-        return {
-            "total_emails": total_emails,
-            "confirmed_deliveries": confirmed_deliveries,
-            "total_value": total_value
-        }
+    
+    return {
+        "total_emails": total_emails,
+        "confirmed_deliveries": confirmed_deliveries,
+        "total_value": total_value
+    }
+
+def get_processing_statistics(user_email: str = None):
+    """Fetch and calculate processing statistics from the database for the specified user."""
+    try:
+        return _query_processing_statistics(user_email)
     except Exception as e:
         st.warning(f"Unable to fetch statistics: {str(e)}")
         return {
@@ -270,11 +576,14 @@ def display_history_table(df: pd.DataFrame):
             st.info("No previous delivery emails analyzed yet.")
             return
 
-        # Format the DataFrame for display
-        display_df = df.copy()
+        # Copy only the columns being formatted for display
+        display_df = df[[
+            'created_at', 'delivery', 'store', 'description', 'price_num',
+            'delivery_date', 'tracking_number', 'carrier'
+        ]].copy()
 
         # Format price as currency
-        display_df['price_num'] = display_df['price_num'].apply(lambda x: f"${x:.2f}" if pd.notnull(x) else "$0.00")
+        display_df['price_num'] = display_df['price_num'].fillna(0).map('${:.2f}'.format)
 
         # Format delivery date
         display_df['delivery_date'] = pd.to_datetime(display_df['delivery_date']).dt.strftime('%B %d, %Y')
@@ -283,9 +592,7 @@ def display_history_table(df: pd.DataFrame):
         display_df['created_at'] = pd.to_datetime(display_df['created_at']).dt.strftime('%Y-%m-%d %H:%M:%S')
 
         # Create delivery status column with emojis
-        display_df['status'] = display_df['delivery'].apply(
-            lambda x: "✅" if x == "yes" else "❌"
-        )
+        display_df['status'] = np.where(display_df['delivery'].eq("yes"), "✅", "❌")
 
         # Reorder and rename columns for display
         columns_to_display = {
@@ -416,23 +723,16 @@ def get_delivery_status_distribution(user_email=None):
             status_counts = [35, 45, 20]
             return pd.DataFrame({'status': status_types, 'count': status_counts})
         
-        # Map delivery values to status labels
+        # Count confirmed/failed in one vectorized pass
         status_map = {'yes': 'Confirmed', 'no': 'Failed'}
-        df['status'] = df['delivery'].map(status_map)
-        
-        # Group by status and count
-        result = df.groupby('status').size().reset_index(name='count')
+        counts = df['delivery'].map(status_map).value_counts().reindex(['Confirmed', 'Failed'], fill_value=0)
         
-        # Make sure we have all status types
-        all_statuses = ['Confirmed', 'Failed', 'Pending']
-        for status in all_statuses:
-            if status not in result['status'].values:
-                if status == 'Pending':
-                    # Add a reasonable "Pending" count
-                    pending_count = max(1, int(df.shape[0] * 0.2))
-                    result = pd.concat([result, pd.DataFrame({'status': [status], 'count': [pending_count]})], ignore_index=True)
-                else:
-                    result = pd.concat([result, pd.DataFrame({'status': [status], 'count': [0]})], ignore_index=True)
+        # Add a reasonable "Pending" count
+        pending_count = max(1, int(df.shape[0] * 0.2))
+        result = pd.DataFrame({
+            'status': ['Confirmed', 'Failed', 'Pending'],
+            'count': [int(counts['Confirmed']), int(counts['Failed']), pending_count]
+        })
         
         return result
     except Exception as e:
@@ -443,11 +743,10 @@ def get_delivery_status_distribution(user_email=None):
 
 def cleanup_old_records(days: int = 30):
     """Delete records older than specified number of days."""
+    conn = get_connection()
+    if conn is None:
+        return False
     try:
-        conn = get_connection()
-        if conn is None:
-            return False
-        
         cursor = conn.cursor()
         cursor.execute("""
             DELETE FROM delivery_details 
@@ -455,8 +754,18 @@ def cleanup_old_records(days: int = 30):
         """, (days,))
         
         conn.commit()
-        conn.close()
+        _invalidate_read_caches()
         return True
     except Exception as e:
         st.error(f"Error cleaning up old records: {str(e)}")
-        return False
\ No newline at end of file
+        return False
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    if sys.argv[1:] == ["--remove-duplicates"]:
+        remove_duplicate_email_rows()
+    else:
+        sys.exit("usage: python database.py --remove-duplicates")